@@ -5,17 +5,26 @@ Deploy on Railway with Python 3.11+
 
 import os
 import re
+import time
+import secrets
+import hashlib
+import shutil
 import asyncio
 import logging
+from collections import OrderedDict
 from datetime import datetime
 from typing import Optional
+from urllib.parse import urlparse
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, MessageEntity
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 import yt_dlp
 import aiohttp
-import aiofiles
+import orjson
+import uvloop
 
 # Configuration
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -24,9 +33,33 @@ BASE44_APP_ID = os.getenv("BASE44_APP_ID")
 BASE44_API_KEY = os.getenv("BASE44_API_KEY")
 ADMIN_IDS = [int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x]
 
+# Webhook (falls back to polling when WEBHOOK_URL is unset)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8080"))
+
 # Limits
 FREE_MAX_SIZE = 1 * 1024 * 1024 * 1024  # 1GB
 PREMIUM_MAX_SIZE = 5 * 1024 * 1024 * 1024  # 5GB
+# The cloud Bot API rejects bot uploads over 50MB. Raise this only when running against a
+# local Bot API server; PTB 20.7 still reads each upload fully into memory before sending.
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", 50 * 1024 * 1024))
+
+# Seconds allowed to send an upload; PTB 20.7 caps multipart writes at 20s unless given per call
+UPLOAD_WRITE_TIMEOUT = 600
+
+# Updates handled at once; downloads await in worker threads, so others keep being served
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# Concurrent yt-dlp downloads (each runs in a worker thread)
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", (os.cpu_count() or 1) * 2))
+
+# Cache
+SETTINGS_TTL = 60  # seconds
+URL_TOKEN_TTL = 60 * 60  # seconds a quality keyboard stays usable
+PROGRESS_EDIT_INTERVAL = 2  # seconds between progress edits of one status message
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "/tmp/dlcache")
+MEDIA_CACHE_MAX_SIZE = int(os.getenv("MEDIA_CACHE_MAX_SIZE", 10 * 1024 * 1024 * 1024))  # 10GB
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,9 +75,35 @@ PLATFORM_PATTERNS = {
     "soundcloud": r"soundcloud\.com",
     "spotify": r"spotify\.com",
 }
+_PLATFORM_RE = re.compile(
+    "|".join(f"(?P<{platform}>{pattern})" for platform, pattern in PLATFORM_PATTERNS.items()),
+    re.IGNORECASE
+)
+
+# Link in a text message
+_URL_RE = re.compile(r"\bhttps?://\S+")
 
 # Quality options
 QUALITY_OPTIONS = ["180p", "240p", "360p", "480p", "720p", "1080p", "1440p", "4k", "best"]
+_HEIGHT = {"180p": 180, "240p": 240, "360p": 360, "480p": 480,
+           "720p": 720, "1080p": 1080, "1440p": 1440, "4k": 2160, "best": None}
+
+# yt-dlp options per quality, minus the per-user output template
+_YDL_OPTS_CACHE: dict[str, dict] = {
+    quality: {
+        "format": f"bestvideo[height<={height}]+bestaudio/best[height<={height}]" if height else "bestvideo+bestaudio/best",
+        "merge_output_format": "mp4",
+    }
+    for quality, height in _HEIGHT.items()
+}
+_YDL_OPTS_CACHE["audio"] = {
+    "format": "bestaudio/best",
+    "postprocessors": [{
+        "key": "FFmpegExtractAudio",
+        "preferredcodec": "mp3",
+        "preferredquality": "192",
+    }],
+}
 
 class Base44Client:
     """Client for syncing data with Base44 dashboard"""
@@ -55,115 +114,505 @@ class Base44Client:
             "Authorization": f"Bearer {BASE44_API_KEY}",
             "X-App-ID": BASE44_APP_ID
         }
+        self._session: Optional[aiohttp.ClientSession] = None
+        # telegram_id -> Base44 record id, so repeat syncs skip the lookup GET
+        self._user_ids: dict[str, str] = {}
+        self._settings_cache: Optional[tuple[float, dict]] = None
+        self._settings_lock = asyncio.Lock()
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # One long-lived session so every call reuses pooled keep-alive connections
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                # aiohttp expects str from json_serialize; orjson returns bytes
+                json_serialize=lambda obj: orjson.dumps(obj).decode(),
+                connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75, ttl_dns_cache=300)
+            )
+        return self._session
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
     
     async def sync_user(self, user_data: dict):
-        async with aiohttp.ClientSession() as session:
-            # Check if user exists
-            async with session.get(
+        session = await self._get_session()
+        telegram_id = user_data["telegram_id"]
+        
+        # Known user: go straight to PATCH
+        record_id = self._user_ids.get(telegram_id)
+        if record_id:
+            async with session.patch(
+                f"{self.base_url}/entities/TelegramUser/{record_id}",
+                json=user_data
+            ) as resp:
+                if 200 <= resp.status < 300:
+                    body = await resp.read()
+                    # Only hand back a real record; 204 or odd bodies mean "unknown"
+                    user = orjson.loads(body) if body else None
+                    return user if isinstance(user, dict) and user.get("id") else None
+            # Deleted on the dashboard or a failed PATCH; fall through to a fresh lookup
+            self._user_ids.pop(telegram_id, None)
+        
+        # Check if user exists
+        async with session.get(
+            f"{self.base_url}/entities/TelegramUser",
+            params={"telegram_id": telegram_id}
+        ) as resp:
+            users = orjson.loads(await resp.read())
+        
+        if users:
+            # Update existing
+            self._user_ids[telegram_id] = users[0]["id"]
+            async with session.patch(
+                f"{self.base_url}/entities/TelegramUser/{users[0]['id']}",
+                json=user_data
+            ):
+                pass
+            return users[0]
+        else:
+            # Create new
+            async with session.post(
                 f"{self.base_url}/entities/TelegramUser",
-                headers=self.headers,
-                params={"telegram_id": user_data["telegram_id"]}
+                json=user_data
             ) as resp:
-                users = await resp.json()
-            
-            if users:
-                # Update existing
-                await session.patch(
-                    f"{self.base_url}/entities/TelegramUser/{users[0]['id']}",
-                    headers=self.headers,
-                    json=user_data
-                )
-                return users[0]
-            else:
-                # Create new
-                async with session.post(
-                    f"{self.base_url}/entities/TelegramUser",
-                    headers=self.headers,
-                    json=user_data
-                ) as resp:
-                    return await resp.json()
+                user = orjson.loads(await resp.read())
+            if user and user.get("id"):
+                self._user_ids[telegram_id] = user["id"]
+            return user
     
     async def get_user(self, telegram_id: str) -> Optional[dict]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/entities/TelegramUser",
-                headers=self.headers,
-                params={"telegram_id": telegram_id}
-            ) as resp:
-                users = await resp.json()
-                return users[0] if users else None
+        session = await self._get_session()
+        async with session.get(
+            f"{self.base_url}/entities/TelegramUser",
+            params={"telegram_id": telegram_id}
+        ) as resp:
+            users = orjson.loads(await resp.read())
+            return users[0] if users else None
     
     async def log_download(self, download_data: dict):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/entities/Download",
-                headers=self.headers,
-                json=download_data
-            ) as resp:
-                return await resp.json()
+        session = await self._get_session()
+        async with session.post(
+            f"{self.base_url}/entities/Download",
+            json=download_data
+        ) as resp:
+            return orjson.loads(await resp.read())
     
     async def update_download(self, download_id: str, data: dict):
-        async with aiohttp.ClientSession() as session:
-            await session.patch(
-                f"{self.base_url}/entities/Download/{download_id}",
-                headers=self.headers,
-                json=data
-            )
+        session = await self._get_session()
+        async with session.patch(
+            f"{self.base_url}/entities/Download/{download_id}",
+            json=data
+        ):
+            pass
     
     async def get_settings(self) -> dict:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/entities/BotSettings",
-                headers=self.headers
-            ) as resp:
-                settings = await resp.json()
-                return {s["setting_key"]: s["setting_value"] for s in settings}
+        cached = self._settings_cache
+        if cached and time.monotonic() - cached[0] < SETTINGS_TTL:
+            return cached[1]
+        
+        async with self._settings_lock:
+            # Another handler may have refreshed while we waited
+            cached = self._settings_cache
+            if cached and time.monotonic() - cached[0] < SETTINGS_TTL:
+                return cached[1]
+            
+            session = await self._get_session()
+            async with session.get(f"{self.base_url}/entities/BotSettings") as resp:
+                settings = orjson.loads(await resp.read())
+            result = {s["setting_key"]: s["setting_value"] for s in settings}
+            self._settings_cache = (time.monotonic(), result)
+            return result
+    
+    def clear_settings_cache(self):
+        self._settings_cache = None
     
     async def get_pending_broadcasts(self) -> list:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/entities/Broadcast",
-                headers=self.headers,
-                params={"status": "draft"}
-            ) as resp:
-                return await resp.json()
+        session = await self._get_session()
+        async with session.get(
+            f"{self.base_url}/entities/Broadcast",
+            params={"status": "draft"}
+        ) as resp:
+            return orjson.loads(await resp.read())
+
+class MediaCache:
+    """LRU of downloaded files on disk, keyed by (url, quality)"""
+    
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.total_size = 0
+        # key -> {"path", "size", "info", "file_id"}, least recently used first
+        self._entries: OrderedDict[tuple[str, str], dict] = OrderedDict()
+        self._paths: set[str] = set()
+    
+    async def get(self, key: tuple[str, str]) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        exists = await asyncio.to_thread(os.path.exists, entry["path"])
+        if self._entries.get(key) is not entry:
+            # Evicted or replaced while we were checking
+            return None
+        if not exists:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+    
+    async def put(self, key: tuple[str, str], info: dict, filename: str) -> tuple[str, list[str]]:
+        """Move a finished download into the cache.
+        
+        Returns its new path and the evicted files to delete. The caller must register its
+        references to the path before awaiting remove(), or a concurrent put could evict it.
+        """
+        digest = hashlib.blake2b(f"{key[0]}|{key[1]}".encode(), digest_size=16).hexdigest()
+        path = os.path.join(self.directory, digest + os.path.splitext(filename)[1])
+        try:
+            size = await asyncio.to_thread(self._move_in, filename, path)
+        except OSError as e:
+            logger.warning(f"Not caching {filename}: {e}")
+            return filename, []
+        if size is None:
+            return filename, []
+        
+        # Index is only touched on the loop, after the file is in place
+        evicted = []
+        if key in self._entries:
+            evicted.append(self._drop(key))
+        self._entries[key] = {
+            "path": path,
+            "size": size,
+            # Only what the handlers read; full yt-dlp info dicts are large
+            "info": {k: info[k] for k in ("title", "duration") if k in info},
+            "file_id": None,
+        }
+        self._paths.add(path)
+        self.total_size += size
+        
+        while self.total_size > self.max_size:
+            evicted.append(self._drop(next(iter(self._entries))))
+        return path, [p for p in evicted if p and p != path]
+    
+    def _move_in(self, filename: str, path: str) -> Optional[int]:
+        """Blocking stat and move into the cache; None if the file is too large to cache"""
+        size = os.path.getsize(filename)
+        if size > self.max_size:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        # shutil.move copies when MEDIA_CACHE_DIR is on another filesystem
+        shutil.move(filename, path)
+        return size
+    
+    async def remove(self, paths: list[str]):
+        if paths:
+            await asyncio.to_thread(self._unlink, paths)
+    
+    @staticmethod
+    def _unlink(paths: list[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    
+    def purge(self):
+        """Remove cache files left by a previous run; the index only lives in memory"""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            # Only our own blake2b-named files, in case the directory is shared
+            stem = os.path.splitext(entry.name)[0]
+            if entry.is_file() and re.fullmatch(r"[0-9a-f]{32}", stem):
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    logger.warning(f"Could not remove stale cache file {entry.path}: {e}")
+    
+    def set_file_id(self, key: tuple[str, str], file_id: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry["file_id"] = file_id
+    
+    def contains(self, path: str) -> bool:
+        return path in self._paths
+    
+    def file_id(self, key: tuple[str, str]) -> Optional[str]:
+        entry = self._entries.get(key)
+        return entry["file_id"] if entry else None
+    
+    def _drop(self, key: tuple[str, str]) -> Optional[str]:
+        """Remove key from the index; returns its path if the caller should delete the file"""
+        entry = self._entries.pop(key)
+        self._paths.discard(entry["path"])
+        self.total_size -= entry["size"]
+        # Files still being uploaded are removed by release_media instead
+        return None if _file_refs.get(entry["path"]) else entry["path"]
+
+class EditThrottle:
+    """Coalesces status message edits so each message is edited at most once per interval"""
+    
+    def __init__(self, message, text: Optional[str] = None, interval: float = PROGRESS_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        # Text the message already shows, so it isn't re-sent ("message is not modified")
+        self._last_text = text
+        self._last_sent = time.monotonic() if text else 0.0
+        self._pending: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+    
+    def set(self, text: str):
+        """Queue text for the message; only the latest text is sent"""
+        if self._closed:
+            return
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+    
+    async def _flush(self):
+        # Keep going until nothing was queued while the previous edit was in flight
+        while self._pending:
+            delay = self._last_sent + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            
+            text, self._pending = self._pending, None
+            if text and text != self._last_text:
+                try:
+                    await self.message.edit_text(text)
+                    self._last_text = text
+                except TelegramError as e:
+                    logger.warning(f"Status edit failed: {e}")
+            self._last_sent = time.monotonic()
+    
+    async def close(self):
+        """Drop any deferred edit so it can't overwrite later status messages"""
+        self._closed = True
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
 base44 = Base44Client()
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_SIZE)
+download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# (url, quality) -> [future of (info, filename), handlers waiting on it, their EditThrottles]
+# for downloads in progress
+_inflight: dict[tuple[str, str], list] = {}
+# filename -> handlers still using the file; it is removed when the count drops to zero
+_file_refs: dict[str, int] = {}
+
+# [unix time, ISO string] of the last formatted timestamp
+_ts_cache = [0.0, ""]
+
+def now_iso() -> str:
+    """UTC ISO timestamp, reformatted at most once per second"""
+    t = time.time()
+    if t - _ts_cache[0] > 1.0:
+        _ts_cache[:] = [t, datetime.utcfromtimestamp(t).isoformat()]
+    return _ts_cache[1]
 
 def detect_platform(url: str) -> str:
-    for platform, pattern in PLATFORM_PATTERNS.items():
-        if re.search(pattern, url, re.IGNORECASE):
-            return platform
-    return "other"
-
-def get_quality_keyboard(url: str) -> InlineKeyboardMarkup:
-    keyboard = []
-    row = []
-    for i, quality in enumerate(QUALITY_OPTIONS):
-        row.append(InlineKeyboardButton(quality, callback_data=f"quality:{quality}:{url[:50]}"))
-        if len(row) == 3:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
+    match = _PLATFORM_RE.search(url)
+    return match.lastgroup if match else "other"
+
+def store_url_token(bot_data: dict, url: str, platform: str) -> str:
+    """Map a short random token to the URL so callback_data stays small"""
+    tokens = bot_data.setdefault("url_tok", {})
+    now = time.monotonic()
     
+    # Drop expired tokens while we're here; insertion order is creation order
+    while tokens:
+        oldest = next(iter(tokens))
+        if now - tokens[oldest][2] <= URL_TOKEN_TTL:
+            break
+        del tokens[oldest]
+    
+    tok = secrets.token_urlsafe(6)
+    tokens[tok] = (url, platform, now)
+    return tok
+
+def resolve_url_token(bot_data: dict, tok: str) -> Optional[tuple[str, str]]:
+    entry = bot_data.get("url_tok", {}).get(tok)
+    if not entry or time.monotonic() - entry[2] > URL_TOKEN_TTL:
+        return None
+    return entry[0], entry[1]
+
+def _build_quality_layout() -> tuple:
+    rows = [
+        tuple((quality, quality) for quality in QUALITY_OPTIONS[i:i + 3])
+        for i in range(0, len(QUALITY_OPTIONS), 3)
+    ]
     # Add audio-only option
-    keyboard.append([InlineKeyboardButton("🎵 Audio Only (MP3)", callback_data=f"quality:audio:{url[:50]}")])
-    return InlineKeyboardMarkup(keyboard)
+    rows.append((("🎵 Audio Only (MP3)", "audio"),))
+    return tuple(rows)
+
+# (label, quality) rows; only the token differs between keyboards
+_QUALITY_LAYOUT = _build_quality_layout()
+
+def get_quality_keyboard(tok: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=f"q:{quality}:{tok}") for label, quality in row]
+        for row in _QUALITY_LAYOUT
+    ])
+
+def _run_ytdlp(ydl_opts: dict, url: str, quality: str) -> tuple[dict, str]:
+    """Blocking yt-dlp download; run via asyncio.to_thread"""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=True)
+        
+        # Final path after merging/postprocessing, as reported by yt-dlp
+        downloads = info.get("requested_downloads")
+        if downloads and downloads[0].get("filepath"):
+            return info, downloads[0]["filepath"]
+        
+        filename = ydl.prepare_filename(info)
+    
+    # Handle audio conversion filename
+    if quality == "audio":
+        filename = filename.rsplit(".", 1)[0] + ".mp3"
+    return info, filename
+
+def _fan_out_progress(throttles: list, text: str):
+    for throttle in throttles:
+        throttle.set(text)
+
+def _progress_hook(throttles: list, loop: asyncio.AbstractEventLoop):
+    """yt-dlp progress hook; runs in the download thread, so hand updates to the loop"""
+    def hook(d: dict):
+        if d.get("status") != "downloading":
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        if total:
+            percent = d.get("downloaded_bytes", 0) * 100 / total
+            loop.call_soon_threadsafe(_fan_out_progress, throttles, f"📥 Downloading... {percent:.0f}%")
+    return hook
+
+async def fetch_media(url: str, quality: str, ydl_opts: dict, throttle: EditThrottle) -> tuple[dict, str]:
+    """Download with yt-dlp, sharing one download between concurrent requests for the same media.
+    
+    Progress goes to every waiting handler's throttle. Every successful call must be paired
+    with await release_media(filename).
+    """
+    key = (url, quality)
+    cached = await media_cache.get(key)
+    if cached:
+        _file_refs[cached["path"]] = _file_refs.get(cached["path"], 0) + 1
+        return cached["info"], cached["path"]
+    
+    entry = _inflight.get(key)
+    if entry:
+        fut = entry[0]
+        entry[1] += 1
+        entry[2].append(throttle)
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.done():
+                entry[1] -= 1
+                entry[2].remove(throttle)
+            elif not fut.cancelled() and fut.exception() is None:
+                # The result landed with our reference already counted
+                await release_media(fut.result()[1])
+            raise
+    
+    fut = asyncio.get_running_loop().create_future()
+    entry = _inflight[key] = [fut, 1, [throttle]]
+    ydl_opts = {**ydl_opts, "progress_hooks": [_progress_hook(entry[2], asyncio.get_running_loop())]}
+    try:
+        async with download_semaphore:
+            info, filename = await asyncio.to_thread(_run_ytdlp, ydl_opts, url, quality)
+        filename, evicted = await media_cache.put(key, info, filename)
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # Mark retrieved in case nobody else was waiting
+        raise
+    finally:
+        del _inflight[key]
+    
+    # Take our references before the next await so a concurrent put can't evict the file
+    _file_refs[filename] = _file_refs.get(filename, 0) + entry[1]
+    fut.set_result((info, filename))
+    try:
+        await media_cache.remove(evicted)
+    except asyncio.CancelledError:
+        # The caller never sees filename, so give our reference back
+        await release_media(filename)
+        raise
+    return info, filename
+
+async def release_media(filename: str):
+    refs = _file_refs.pop(filename, 1) - 1
+    if refs > 0:
+        _file_refs[filename] = refs
+    elif not media_cache.contains(filename):
+        try:
+            await asyncio.to_thread(os.remove, filename)
+        except FileNotFoundError:
+            pass
+
+def _load_input_file(filename: str, upload_name: str) -> InputFile:
+    """Blocking read of the whole file into an InputFile; run via asyncio.to_thread"""
+    with open(filename, "rb") as f:
+        return InputFile(f, filename=upload_name)
+
+async def send_media(chat, quality: str, media, title: str):
+    if quality == "audio":
+        return await chat.send_audio(
+            audio=media,
+            title=title,
+            filename=f"{title}.mp3",
+            caption=f"🎵 {title}",
+            write_timeout=UPLOAD_WRITE_TIMEOUT
+        )
+    return await chat.send_video(
+        video=media,
+        filename=f"{title}.mp4",
+        caption=f"🎬 {title}\n📊 Quality: {quality}",
+        write_timeout=UPLOAD_WRITE_TIMEOUT
+    )
+
+async def update_user_stats(user_data: dict, telegram_id: str, db_user: dict, stats_gen: int, file_size: int):
+    """Add one download to the user's totals.
+    
+    Handlers run concurrently, so the same user's downloads can finish together. Updates are
+    serialized per user, and totals are refetched if another download was counted after
+    db_user was read.
+    """
+    async with user_data.setdefault("stats_lock", asyncio.Lock()):
+        if user_data.get("stats_gen", 0) != stats_gen:
+            db_user = await base44.get_user(telegram_id) or db_user
+        await base44.sync_user({
+            "telegram_id": telegram_id,
+            "total_downloads": (db_user.get("total_downloads", 0) or 0) + 1,
+            "total_data_downloaded": (db_user.get("total_data_downloaded", 0) or 0) + file_size
+        })
+        user_data["stats_gen"] = user_data.get("stats_gen", 0) + 1
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    # Sync user to Base44
-    await base44.sync_user({
-        "telegram_id": str(user.id),
-        "username": user.username,
-        "first_name": user.first_name,
-        "last_name": user.last_name or "",
-        "last_active": datetime.utcnow().isoformat()
-    })
-    
-    settings = await base44.get_settings()
+    # Sync user to Base44 while fetching settings
+    _, settings = await asyncio.gather(
+        base44.sync_user({
+            "telegram_id": str(user.id),
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name or "",
+            "last_active": now_iso()
+        }),
+        base44.get_settings()
+    )
     welcome_msg = settings.get("welcome_message", "Welcome! Send me a link to download.")
     
     await update.message.reply_text(welcome_msg, parse_mode=ParseMode.MARKDOWN)
@@ -179,26 +628,38 @@ async def premium_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(premium_msg, parse_mode=ParseMode.MARKDOWN)
 
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    url = update.message.text.strip()
+    # Telegram's URL entity already excludes surrounding punctuation; take the first
+    # http(s) link, the same kind the message filter matched (bare domains are skipped)
+    links = update.message.parse_entities([MessageEntity.URL])
+    url = next((
+        text for entity, text in sorted(links.items(), key=lambda item: item[0].offset)
+        if _URL_RE.match(text)
+    ), None)
+    if not url:
+        return
     user = update.effective_user
     
-    # Update last active
-    await base44.sync_user({
+    # Update last active; keep the record for the quality selection that follows
+    synced = await base44.sync_user({
         "telegram_id": str(user.id),
-        "last_active": datetime.utcnow().isoformat()
+        "last_active": now_iso()
     })
+    # Only a real record for this user; anything else makes the handler refetch
+    if isinstance(synced, dict) and synced.get("id") and synced.get("telegram_id") == str(user.id):
+        context.user_data["db_user"] = synced
+    else:
+        context.user_data.pop("db_user", None)
     
     # Detect platform
     platform = detect_platform(url)
     
-    # Store URL in context for callback
-    context.user_data["pending_url"] = url
-    context.user_data["platform"] = platform
+    # Store URL for the callback under a short token
+    tok = store_url_token(context.bot_data, url, platform)
     
     # Show quality selection
     await update.message.reply_text(
         f"🎬 Detected: *{platform.upper()}*\n\nSelect quality:",
-        reply_markup=get_quality_keyboard(url),
+        reply_markup=get_quality_keyboard(tok),
         parse_mode=ParseMode.MARKDOWN
     )
 
@@ -206,18 +667,18 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     
-    data = query.data.split(":")
-    quality = data[1]
-    url = context.user_data.get("pending_url", "")
-    platform = context.user_data.get("platform", "other")
+    _, quality, tok = query.data.split(":", 2)
     user = update.effective_user
     
-    if not url:
+    resolved = resolve_url_token(context.bot_data, tok)
+    if not resolved:
         await query.edit_message_text("❌ Session expired. Please send the link again.")
         return
+    url, platform = resolved
     
-    # Check user limits
-    db_user = await base44.get_user(str(user.id))
+    # Check user limits (record synced by handle_url is used once, then refetched)
+    stats_gen = context.user_data.get("stats_gen", 0)
+    db_user = context.user_data.pop("db_user", None) or await base44.get_user(str(user.id))
     is_premium = db_user.get("is_premium", False) if db_user else False
     is_banned = db_user.get("is_banned", False) if db_user else False
     
@@ -240,48 +701,42 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
     download_id = download_record.get("id")
     
     status_msg = await query.edit_message_text("⏳ Starting download...")
+    filename = None
     
     try:
         # Configure yt-dlp
-        if quality == "audio":
-            ydl_opts = {
-                "format": "bestaudio/best",
-                "postprocessors": [{
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "192",
-                }],
-                "outtmpl": f"/tmp/{user.id}_%(title)s.%(ext)s",
-            }
-        else:
-            height = {"180p": 180, "240p": 240, "360p": 360, "480p": 480, 
-                     "720p": 720, "1080p": 1080, "1440p": 1440, "4k": 2160, "best": None}[quality]
-            
-            format_str = f"bestvideo[height<={height}]+bestaudio/best[height<={height}]" if height else "bestvideo+bestaudio/best"
-            
-            ydl_opts = {
-                "format": format_str,
-                "merge_output_format": "mp4",
-                "outtmpl": f"/tmp/{user.id}_%(title)s.%(ext)s",
-            }
+        ydl_opts = {
+            **_YDL_OPTS_CACHE[quality],
+            "outtmpl": {"default": f"/tmp/{user.id}_%(id)s_{quality}.%(ext)s"},
+        }
         
         # Download
-        await status_msg.edit_text("📥 Downloading... 0%")
+        progress_text = "📥 Downloading... 0%"
+        await status_msg.edit_text(progress_text)
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get("title", "video")
-            filename = ydl.prepare_filename(info)
-            
-            # Handle audio conversion filename
-            if quality == "audio":
-                filename = filename.rsplit(".", 1)[0] + ".mp3"
+        throttle = EditThrottle(status_msg, progress_text)
+        try:
+            info, filename = await fetch_media(url, quality, ydl_opts, throttle)
+        finally:
+            await throttle.close()
+        title = info.get("title", "video")
         
         # Check file size
-        file_size = os.path.getsize(filename)
+        file_size = await asyncio.to_thread(os.path.getsize, filename)
+        
+        # Nothing above the Bot API limit can be sent, so don't load it into memory at all
+        if file_size > UPLOAD_MAX_SIZE and not media_cache.file_id((url, quality)):
+            limit_mb = UPLOAD_MAX_SIZE / (1024**2)
+            await base44.update_download(download_id, {
+                "status": "failed",
+                "error_message": f"File too large to upload ({file_size / (1024**2):.0f}MB > {limit_mb:.0f}MB Bot API limit)"
+            })
+            await status_msg.edit_text(
+                f"❌ File is {file_size / (1024**2):.0f}MB, above Telegram's {limit_mb:.0f}MB upload limit for bots."
+            )
+            return
         
         if file_size > max_size:
-            os.remove(filename)
             limit_gb = max_size / (1024**3)
             await base44.update_download(download_id, {
                 "status": "failed",
@@ -300,44 +755,34 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
         # Upload to Telegram
         await status_msg.edit_text("📤 Uploading to Telegram...")
         
-        async with aiofiles.open(filename, "rb") as f:
-            file_data = await f.read()
-        
-        if quality == "audio":
-            await update.effective_chat.send_audio(
-                audio=file_data,
-                title=title,
-                filename=f"{title}.mp3",
-                caption=f"🎵 {title}"
-            )
+        # Media Telegram already has is re-sent by file_id without uploading
+        file_id = media_cache.file_id((url, quality))
+        if file_id:
+            await send_media(update.effective_chat, quality, file_id, title)
         else:
-            await update.effective_chat.send_video(
-                video=file_data,
-                filename=f"{title}.mp4",
-                caption=f"🎬 {title}\n📊 Quality: {quality}"
-            )
+            # PTB 20.7 buffers the whole upload in memory, so at least load it off the loop
+            upload_name = f"{title}.mp3" if quality == "audio" else f"{title}.mp4"
+            media_file = await asyncio.to_thread(_load_input_file, filename, upload_name)
+            message = await send_media(update.effective_chat, quality, media_file, title)
+            sent = message.audio if quality == "audio" else message.video
+            if sent:
+                media_cache.set_file_id((url, quality), sent.file_id)
         
-        # Update download record
-        await base44.update_download(download_id, {
+        # Update download record and user stats concurrently
+        writes = [base44.update_download(download_id, {
             "status": "completed",
             "title": title,
             "file_size": file_size,
             "duration": info.get("duration")
-        })
-        
-        # Update user stats
+        })]
         if db_user:
-            await base44.sync_user({
-                "telegram_id": str(user.id),
-                "total_downloads": (db_user.get("total_downloads", 0) or 0) + 1,
-                "total_data_downloaded": (db_user.get("total_data_downloaded", 0) or 0) + file_size
-            })
+            writes.append(update_user_stats(context.user_data, str(user.id), db_user, stats_gen, file_size))
+        for result in await asyncio.gather(*writes, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Base44 update error: {result}")
         
         await status_msg.edit_text("✅ Download complete!")
         
-        # Cleanup
-        os.remove(filename)
-        
     except Exception as e:
         logger.error(f"Download error: {e}")
         await base44.update_download(download_id, {
@@ -348,6 +793,11 @@ async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT
         settings = await base44.get_settings()
         error_msg = settings.get("error_message", "❌ Download failed.")
         await status_msg.edit_text(f"{error_msg}\n\nError: {str(e)[:100]}")
+    
+    finally:
+        # Cleanup
+        if filename:
+            await release_media(filename)
 
 # Admin commands
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -358,6 +808,14 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Broadcast logic - get from Base44 dashboard
     await update.message.reply_text("📡 Broadcasts are managed from the dashboard.")
 
+async def reload_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        return
+    
+    base44.clear_settings_cache()
+    await update.message.reply_text("🔄 Settings cache cleared.")
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     db_user = await base44.get_user(str(user.id))
@@ -378,8 +836,35 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("No stats yet. Start downloading!")
 
+async def on_startup(app: Application):
+    await asyncio.to_thread(media_cache.purge)
+
+async def on_shutdown(app: Application):
+    await base44.close()
+
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    uvloop.install()
+    
+    # Large HTTP/2 pool for bot API calls; getUpdates gets its own single connection
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        http_version="2",
+        read_timeout=60,
+        write_timeout=UPLOAD_WRITE_TIMEOUT,
+        pool_timeout=5
+    )
+    get_updates_request = HTTPXRequest(connection_pool_size=1, http_version="2")
+    
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Handlers
     app.add_handler(CommandHandler("start", start))
@@ -387,11 +872,27 @@ def main():
     app.add_handler(CommandHandler("premium", premium_command))
     app.add_handler(CommandHandler("broadcast", broadcast))
     app.add_handler(CommandHandler("stats", stats))
-    app.add_handler(CallbackQueryHandler(handle_quality_selection, pattern="^quality:"))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"https?://"), handle_url))
+    app.add_handler(CommandHandler("reload_settings", reload_settings))
+    app.add_handler(CallbackQueryHandler(handle_quality_selection, pattern="^q:"))
+    # Telegram's own URL entity check runs first, so most non-link text never reaches the regex
+    app.add_handler(MessageHandler(
+        filters.TEXT & filters.Entity(MessageEntity.URL) & filters.Regex(_URL_RE),
+        handle_url
+    ))
     
     logger.info("Bot starting...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            # Serve on the same path Telegram is told to post to
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            # Never run a public webhook without a secret; run_webhook registers it with Telegram
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()